@@ -12,18 +12,43 @@
 
 """
 import json
+import os
 import pathlib
 import argparse
+import functools
 import re
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from typing import Optional
 
-C_VAR_NAME = re.compile('[_a-zA-Z]+[_a-zA-Z0-9.\\[\\]]*')
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-C_CPP_KEYWORDS = {'auto', 'break', 'case', 'catch', 'char', 'const',
-                  'continue', 'default', 'do', 'double', 'else',
-                  'enum', 'extern', 'float', 'for', 'goto', 'if',
-                  'int', 'long', 'register', 'return', 'short',
-                  'signed', 'sizeof', 'static', 'struct', 'switch', 'try',
-                  'typedef', 'union', 'unsigned', 'void', 'volatile', 'while', 'when'}
+_NAME_TOKEN = '[_a-zA-Z][_a-zA-Z0-9.\\[\\]]*'
+# 紧邻引号或括号的名称由前两个分支整体吞掉，只有第三个分支（捕获组）中的名称才可能是变量名
+C_VAR_NAME = re.compile(f'[\'")]{_NAME_TOKEN}|{_NAME_TOKEN}(?=[\'"(])|({_NAME_TOKEN})')
+
+_LOWER_RE = re.compile('[a-z]')
+
+# 行首的函数定义，如 "static char *original_uri(request_rec *r)"、"AP_DECLARE(int) ap_foo(void)"
+# 或返回类型单独占一行时的 "original_uri(request_rec *r)"
+C_FUNC_DEF = re.compile('(?:[_A-Z][_A-Z0-9]*\\([^()]*\\)[ \t*]*)?(?:[_a-zA-Z][_a-zA-Z0-9 \t*]*[ \t*])?([_a-zA-Z][_a-zA-Z0-9]*)[ \t]*\\(')
+
+C_SOURCE_SUFFIXES = ('.c', '.cc', '.cpp', '.cxx', '.h', '.hh', '.hpp')
+
+# 启动时缓存一次当前目录，避免 Path.absolute() 每次调用 os.getcwd()
+CWD = pathlib.Path.cwd()
+
+C_CPP_KEYWORDS = frozenset({'auto', 'break', 'case', 'catch', 'char', 'const',
+                            'continue', 'default', 'do', 'double', 'else',
+                            'enum', 'extern', 'float', 'for', 'goto', 'if',
+                            'int', 'long', 'register', 'return', 'short',
+                            'signed', 'sizeof', 'static', 'struct', 'switch', 'try',
+                            'typedef', 'union', 'unsigned', 'void', 'volatile', 'while', 'when'})
 class SVFTag:
     # vanilla tags
     class DefectType:
@@ -59,36 +84,90 @@ class TransformMessage:
     DFFIC = "Duplicated Files Found In Conditions Analysis"
     NSFIC = "No Such File In Conditions Analysis"
 
+# 输出不是终端（重定向到文件、CI 等）时不输出颜色控制符
+_USE_COLOR = sys.stdout.isatty()
+_OK_PREFIX = "\033[32m[SRT]\033[0m " if _USE_COLOR else "[SRT] "
+_WARN_PREFIX = "\033[33m[SRT Warning]\033[0m " if _USE_COLOR else "[SRT Warning] "
+_FATAL_PREFIX = "\033[31m[SRT Fatal Error]\033[0m " if _USE_COLOR else "[SRT Fatal Error] "
+_ERR_PREFIX = "\033[31m[SRT]\033[0m " if _USE_COLOR else "[SRT] "
+
+def _log_ok(msg:str):
+    print(_OK_PREFIX + msg)
+
+def _log_warn(msg:str):
+    print(_WARN_PREFIX + msg)
+
+def _log_fatal(msg:str):
+    print(_FATAL_PREFIX + msg)
+
+def _log_err(msg:str):
+    print(_ERR_PREFIX + msg)
+
 def SRT_log(success:bool, msg:str, error:str= ""):
     if success:
-        print("\033[32m[SRT]\033[0m " + msg)
+        _log_ok(msg)
+    elif error == "warning":
+        _log_warn(msg)
+    elif error == "fatal":
+        _log_fatal(msg)
+    else:
+        _log_err(msg)
+
+def load_json(f) -> list:
+    """
+    读取 JSON 报告，安装了 orjson 时使用 orjson 解析
+    :param f: 以二进制模式打开的文件
+    """
+    if orjson is not None:
+        return orjson.loads(f.read())
+    return json.load(f)
+
+def dump_json(obj, f):
+    """
+    写出 JSON 报告，安装了 orjson 时使用 orjson 序列化（orjson 只支持两格缩进）
+    逐条警报写出，不在内存中拼出整个报告的字符串
+    :param obj: 要写出的对象
+    :param f: 以二进制模式打开的文件
+    """
+    if orjson is not None:
+        if not isinstance(obj, list):
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+            return
+        f.write(b'[')
+        for i, item in enumerate(obj):
+            f.write(b',\n' if i else b'\n')
+            f.write(orjson.dumps(item, option=orjson.OPT_INDENT_2))
+        f.write(b'\n]' if obj else b']')
     else:
-        if error == "warning":
-            print("\033[33m[SRT Warning]\033[0m " + msg)
-        elif error == "fatal":
-            print("\033[31m[SRT Fatal Error]\033[0m " + msg)
-        else:
-            print("\033[31m[SRT]\033[0m " + msg)
-
-def deal_duplicate(ln:int, co:int, files:list[pathlib.Path], func_name:str="") -> tuple:
-    res:list[pathlib.Path] = []
+        for chunk in json.JSONEncoder(indent=4).iterencode(obj):
+            f.write(chunk.encode())
+
+@functools.lru_cache(maxsize=512)
+def _read_lines(path_str:str) -> tuple[str, ...]:
+    """
+    读取源文件的所有行并缓存，同一文件在多条警报中出现时只打开一次
+    :param path_str: 文件的绝对路径
+    :return: 文件所有行组成的 tuple
+    """
+    with open(path_str) as f:
+        return tuple(f.readlines())
+
+def deal_duplicate(ln:int, co:int, files:list[str], func_name:str="") -> tuple:
+    res:list[str] = []
     for file in files:
-        adir = file.absolute()
-        with open(adir) as test_file:
-            lines = test_file.readlines()
-            if len(lines) < ln:
-                continue
-            if len(lines[ln - 1]) < co:
-                continue
-            if func_name:
-                flag = False
-                for line in lines[:ln]:
-                    if func_name in line:
-                        flag = True
-                        break
-                if not flag:
-                    continue
-            res.append(file)
+        # 只读到第 ln 行为止，不需要把整个文件读入内存
+        target_line = None
+        func_seen = not func_name
+        with open(file) as test_file:
+            for i, line in enumerate(test_file, 1):
+                if not func_seen and func_name in line:
+                    func_seen = True
+                if i == ln:
+                    target_line = line
+                    break
+        if target_line is None or len(target_line) < co or not func_seen:
+            continue
+        res.append(file)
     if len(res) > 1:
         return 1, None
     elif len(res) == 1:
@@ -96,34 +175,187 @@ def deal_duplicate(ln:int, co:int, files:list[pathlib.Path], func_name:str="") -
     else:
         return -1, None
 
+def locate_source(index:dict[str, list[str]], svf_file:str, ln:int, co:int, func_name:str="",
+                  func_index:Optional[dict[tuple[str, str], list[tuple[str, int]]]]=None) -> tuple[int, Optional[pathlib.Path], str]:
+    """
+    根据SVF报告中的文件名定位源文件，存在同名文件时先查找定义了 func_name 的文件，仍无法确定时调用 deal_duplicate 进一步筛选
+    :param index: build_basename_index 建立的文件名索引
+    :param svf_file: SVF报告中的文件名
+    :param ln: 行号
+    :param co: 列号
+    :param func_name: 所在函数名，为空时不用于筛选
+    :param func_index: build_function_index 建立的函数定义索引
+    :return: (标志, 文件路径, 文件绝对路径)，标志 0 表示唯一定位，1 表示存在多个候选，-1 表示没有找到
+    """
+    ori_path:Optional[list[str]] = index.get(svf_file)
+    if not ori_path:
+        return -1, None, ""
+    if len(ori_path) == 1:
+        src_file = pathlib.Path(ori_path[0])
+    else:
+        if func_name and func_index is not None:
+            # 函数定义必须出现在警报所在行之前
+            hits = [path for path, def_ln in func_index.get((svf_file, func_name), []) if def_ln <= ln]
+            if len(hits) == 1:
+                src_file = pathlib.Path(hits[0])
+                adir = str(CWD / src_file)
+                lines = _read_lines(adir)
+                if 0 < ln <= len(lines) and len(lines[ln - 1]) >= co:
+                    return 0, src_file, adir
+        flag, path_str = deal_duplicate(ln, co, ori_path, func_name)
+        if flag != 0:
+            return flag, None, ""
+        src_file = pathlib.Path(path_str)
+    return 0, src_file, str(CWD / src_file)
+
 def are_all_letters_uppercase(s:str):
-    letters = [char for char in s if char.isalpha()]
-    return all(letter.isupper() for letter in letters)
+    return not _LOWER_RE.search(s)
 
-def name_filter(lstr: str, it: iter, cap_assert:bool) -> list[str]:
+def name_filter(lstr: str, cap_assert:bool) -> list[str]:
     """
     用简易快速的办法过滤不可能是变量名的字符串
-    1. 变量名周围不应有引号
-    2. 变量名周围括号的存在应该合法
+    1. 变量名周围不应有引号（由 C_VAR_NAME 排除）
+    2. 变量名周围括号的存在应该合法（由 C_VAR_NAME 排除）
     3. 假设全大写字母名称为常量或者宏
     4. 排除C/C++关键字
     :param cap_assert: 假设全大写字母名称为常量或者宏
     :param lstr: 包含该字符串的代码行
-    :param it: re.match 类型的 iter
     :return: 过滤后的字符串 list
     """
-    res = []
-    for name in it:
-        start = name.start()
-        end = name.end()
-        if (lstr[max(0, start - 1)] == '\'' or lstr[max(0, start - 1)] == '\"'
-                or lstr[min(len(lstr) - 1, end)] == '\'' or lstr[min(len(lstr) - 1, end)] == '\"'
-                or lstr[max(0, start - 1)] == ')' or lstr[min(len(lstr) - 1, end)] == '(' ):
+    res_list = []
+    seen = set()
+    # C_VAR_NAME 只有一个捕获组，findall 直接返回字符串，被排除的名称对应空串
+    for name_str in C_VAR_NAME.findall(lstr):
+        if (name_str and name_str not in seen and name_str not in C_CPP_KEYWORDS
+                and (not are_all_letters_uppercase(name_str) or not cap_assert)):
+            seen.add(name_str)
+            res_list.append(name_str)
+    return res_list
+
+def build_basename_index(root: str) -> dict[str, list[str]]:
+    """
+    遍历一次源码目录，建立 文件名 -> 路径列表 的索引，避免对每条警报重复遍历整个目录
+    使用 os.scandir 与显式栈代替递归，且只保存字符串路径，不为中间目录构造 Path 对象
+    :param root: 源代码根目录
+    :return: 以文件名为键的路径索引
+    """
+    index: dict[str, list[str]] = defaultdict(list)
+    stack: list[str] = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        index[entry.name].append(entry.path)
+        except OSError:
             continue
-        if (lstr[start:end] not in res and lstr[start:end] not in C_CPP_KEYWORDS
-                and (not are_all_letters_uppercase(lstr[start:end]) or not cap_assert)):
-            res.append(lstr[start:end])
-    return res
+    return index
+
+def build_function_index(index:dict[str, list[str]], names:set[str]) -> dict[tuple[str, str], list[tuple[str, int]]]:
+    """
+    为存在同名文件的 C/C++ 源文件建立 (文件名, 函数名) -> (路径, 定义所在行号) 列表 的索引，使大多数同名文件可以直接由警报所在函数确定
+    只扫描报告中出现过的文件名，不需要区分的文件不会被读取
+    :param index: build_basename_index 建立的文件名索引
+    :param names: 报告中出现的文件名
+    :return: 以 (文件名, 函数名) 为键的索引
+    """
+    func_index: dict[tuple[str, str], list[tuple[str, int]]] = defaultdict(list)
+    for name in names:
+        paths = index.get(name)
+        if not paths or len(paths) < 2 or not name.endswith(C_SOURCE_SUFFIXES):
+            continue
+        for path in paths:
+            try:
+                lines = _read_lines(str(CWD / path))
+            except (OSError, UnicodeDecodeError):
+                continue
+            funcs: dict[str, int] = {}
+            for i, line in enumerate(lines, 1):
+                m = C_FUNC_DEF.match(line)
+                if m:
+                    funcs.setdefault(m.group(1), i)
+            for func, def_ln in funcs.items():
+                func_index[(name, func)].append((path, def_ln))
+    return func_index
+
+def process_warning(warn:dict, cnt:int, index:dict[str, list[str]],
+                    func_index:dict[tuple[str, str], list[tuple[str, int]]], copy_range:int, cap_assert:bool) -> list[tuple]:
+    """
+    处理单条警报，直接在 warn 上增加新的字段
+    各条警报之间互不依赖，可以在线程池中并行处理；日志不在这里输出，而是返回给主线程按顺序输出
+    :param warn: SVF报告中的一条警报
+    :param cnt: 警报序号
+    :param index: build_basename_index 建立的文件名索引
+    :param func_index: build_function_index 建立的函数定义索引
+    :param copy_range: 警报位置附近的拷贝行数
+    :param cap_assert: 假设全大写字母名称为常量或者宏
+    :return: SRT_log 的参数组成的 list
+    """
+    logs:list[tuple] = []
+    # 0. 初始化要增加的key
+    warn[SVFTag.V] = []
+    warn[SVFTag.Code] = []
+    warn[SVFTag.Flag] = ""
+    warn[SVFTag.Msg] = ""
+
+    loc = warn[SVFTag.Loc]
+    ln:int = loc[SVFTag.l]
+    co:int = loc[SVFTag.c]
+    svf_file:str = loc[SVFTag.f]
+    func_name:str = warn[SVFTag.Func]
+
+    # 1. 根据文件名生成实际相对路径
+    flag, src_file, adir = locate_source(index, svf_file, ln, co, func_name, func_index)
+    if flag == 1:
+        warn[SVFTag.Flag] = SVFTag.false
+        warn[SVFTag.Msg] = TransformMessage.DFF
+        logs.append((False, f"Find duplicated file path of file \"{svf_file}\" of warning {cnt}.", "warning"))
+        return logs
+    elif flag == -1:
+        warn[SVFTag.Flag] = SVFTag.false
+        warn[SVFTag.Msg] = TransformMessage.NSF
+        logs.append((False, f"Cannot find file path of file \"{svf_file}\" of warning {cnt}.", "warning"))
+        return logs
+    loc[SVFTag.f] = str(src_file)
+
+    # 2. 推断变量名
+    start = max(0, ln - 1 - copy_range)
+    lines = _read_lines(adir)[start:ln + copy_range]
+    line = lines[ln - 1 - start]
+    var_name:list[str] = name_filter(line, cap_assert)
+    warn[SVFTag.V] = var_name
+
+    # 3. 摘录附近行代码 在这里需要对PartialLeak的分支条件做更多的摘录
+    lines = [line.strip() for line in lines]
+    warn[SVFTag.Code] = lines
+
+    # 3.1 PartialLeak分支的特殊处理
+    if warn[SVFTag.DT] == SVFTag.DefectType.PL:
+        conditional_paths = warn[SVFTag.Des][SVFTag.CFP]
+        for cond in conditional_paths:
+            bl = cond[SVFTag.BL]
+            c_ln: int = bl[SVFTag.l]
+            c_file: str = bl[SVFTag.f]
+            flag, src_file, adir = locate_source(index, c_file, c_ln, bl[SVFTag.c])
+            if flag == 1:
+                warn[SVFTag.Flag] = SVFTag.false
+                warn[SVFTag.Msg] = TransformMessage.DFFIC
+                logs.append((False, f"Find duplicated file path of file \"{c_file}\" of warning {cnt} during conditional free path analysis.",
+                             "warning"))
+                continue
+            elif flag == -1:
+                warn[SVFTag.Flag] = SVFTag.false
+                warn[SVFTag.Msg] = TransformMessage.NSFIC
+                logs.append((False, f"Cannot find file path of file \"{c_file}\" of warning {cnt} during conditional free path analysis.",
+                             "warning"))
+                continue
+            bl[SVFTag.f] = str(src_file)
+            cond[SVFTag.Code] = _read_lines(adir)[c_ln - 1].strip()
+    warn[SVFTag.Flag] = SVFTag.true
+    warn[SVFTag.Msg] = TransformMessage.AC
+    return logs
 
 
 if __name__ == '__main__':
@@ -147,117 +379,31 @@ if __name__ == '__main__':
     parser.add_argument('--cap_not_name', type=bool,
                         default=True,
                         help='Assert if a name contains no lower characters, it is a const value or a macro.')
+    parser.add_argument('--jobs', type=int,
+                        default=0,
+                        help='Set the number of worker threads. (0 means min(32, 4 * cpu_count))')
 
     # parse the args
     args = parser.parse_args()
     rdir = args.root_dir
+    basename_index = build_basename_index(rdir)
 
-    with open(args.input_file, 'r') as jsonf:
-        report = json.load(jsonf)
+    with open(args.input_file, 'rb') as jsonf:
+        report = load_json(jsonf)
         SRT_log(True, "Successfully loaded JSON file: " + str(args.input_file))
         SRT_log(True, f"There are {len(report)} warnings in this report.")
-        cnt = -1
-        for warn in report:
-            cnt += 1
-            # 0. 初始化要增加的key
-            warn[SVFTag.V] = []
-            warn[SVFTag.Code] = []
-            warn[SVFTag.Flag] = ""
-            warn[SVFTag.Msg] = ""
-
-
-
-            # 1. 根据文件名生成实际相对路径
-            svf_file:str = warn[SVFTag.Loc][SVFTag.f]
-            pl:pathlib.Path = pathlib.Path()
-            target_files = pl.rglob(svf_file)
-            ori_path:list[pathlib.Path] = []
-            src_file:pathlib.Path = pathlib.Path()
-            for each in target_files:
-                ori_path.append(each)
-            if len(ori_path) == 1:
-                warn[SVFTag.Loc][SVFTag.f] = str(ori_path[0])
-                src_file = ori_path[0]
-            elif len(ori_path) == 0:
-                warn[SVFTag.Flag] = SVFTag.false
-                warn[SVFTag.Msg] = TransformMessage.NSF
-                SRT_log(False, f"Cannot find file path of file \"{svf_file}\" of warning {cnt}.", error="warning")
-                continue
-            else:
-
-                flag, src_file = deal_duplicate(warn[SVFTag.Loc][SVFTag.l], warn[SVFTag.Loc][SVFTag.c], ori_path, warn[SVFTag.Func])
-                if flag == 1:
-                    warn[SVFTag.Flag] = SVFTag.false
-                    warn[SVFTag.Msg] = TransformMessage.DFF
-                    SRT_log(False, f"Find duplicated file path of file \"{svf_file}\" of warning {cnt}.",
-                            error="warning")
-                    continue
-                elif flag == -1:
-                    warn[SVFTag.Flag] = SVFTag.false
-                    warn[SVFTag.Msg] = TransformMessage.NSF
-                    SRT_log(False, f"Cannot find file path of file \"{svf_file}\" of warning {cnt}.", error="warning")
-                    continue
-
-            adir = str(src_file.absolute())
-            with open(adir) as code_file:
-                # 2. 推断变量名
-                lines = code_file.readlines()
-                l:int = warn[SVFTag.Loc][SVFTag.l]
-                line = lines[l - 1]
-                c = warn[SVFTag.Loc][SVFTag.c]
-                name_iter = C_VAR_NAME.finditer(line)
-                var_name:list[str] = name_filter(line, name_iter, args.cap_not_name)
-                warn[SVFTag.V] = var_name
-
-                # 3. 摘录附近行代码 在这里需要对PartialLeak的分支条件做更多的摘录
-                lines = lines[max(0, l - 1 - args.copy_range):min(len(lines), l + args.copy_range)]
-                lines = [line.lstrip().rstrip() for line in lines]
-                warn[SVFTag.Code] = lines
-
-                # 3.1 PartialLeak分支的特殊处理
-                if warn[SVFTag.DT] == SVFTag.DefectType.PL:
-                    conditional_paths = warn[SVFTag.Des][SVFTag.CFP]
-                    for cond in conditional_paths:
-                        l: int = cond[SVFTag.BL][SVFTag.l]
-                        svf_file: str = cond[SVFTag.BL][SVFTag.f]
-                        pl: pathlib.Path = pathlib.Path()
-                        target_files = pl.rglob(svf_file)
-                        ori_path: list[pathlib.Path] = []
-                        src_file: pathlib.Path = pathlib.Path()
-                        for each in target_files:
-                            ori_path.append(each)
-                        if len(ori_path) == 1:
-                            cond[SVFTag.BL][SVFTag.f] = str(ori_path[0])
-                            src_file = ori_path[0]
-                        elif len(ori_path) == 0:
-                            warn[SVFTag.Flag] = SVFTag.false
-                            warn[SVFTag.Msg] = TransformMessage.NSF
-                            SRT_log(False, f"Cannot find file path of file \"{svf_file}\" of warning {cnt} during conditional free path analysis.",
-                                    error="warning")
-                            continue
-                        else:
-                            flag, src_file = deal_duplicate(warn[SVFTag.Loc][SVFTag.l], warn[SVFTag.Loc][SVFTag.c],
-                                                            ori_path)
-                            if flag == 1:
-                                warn[SVFTag.Flag] = SVFTag.false
-                                warn[SVFTag.Msg] = TransformMessage.DFFIC
-                                SRT_log(False, f"Find duplicated file path of file \"{svf_file}\" of warning {cnt} during conditional free ath analysis.",
-                                        error="warning")
-                                continue
-                            elif flag == -1:
-                                warn[SVFTag.Flag] = SVFTag.false
-                                warn[SVFTag.Msg] = TransformMessage.NSFIC
-                                SRT_log(False, f"Cannot find file path of file \"{svf_file}\" of warning {cnt} during conditional free ath analysis.",
-                                        error="warning")
-                                continue
-                        adir = str(src_file.absolute())
-                        with open(adir) as condition_file:
-                            lines = condition_file.readlines()
-                            cond[SVFTag.Code] = lines[l - 1].lstrip().rstrip()
-            warn[SVFTag.Flag] = SVFTag.true
-            warn[SVFTag.Msg] = TransformMessage.AC
-
-        with open(args.output_file, 'w') as outf:
-            json.dump(report, outf, indent=4)
+        function_index = build_function_index(basename_index,
+                                              {warn[SVFTag.Loc][SVFTag.f] for warn in report if warn[SVFTag.Func]})
+        workers = args.jobs if args.jobs > 0 else min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(process_warning, report, range(len(report)), repeat(basename_index),
+                                   repeat(function_index),
+                                   repeat(args.copy_range), repeat(args.cap_not_name))
+            for logs in results:
+                for log in logs:
+                    SRT_log(*log)
+
+        with open(args.output_file, 'wb') as outf:
+            dump_json(report, outf)
             SRT_log(True, "Successfully dumped JSON output: " + str(args.output_file))
 